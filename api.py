@@ -1,6 +1,7 @@
 import os
 import json
 import tempfile
+import threading
 from uuid import uuid4
 from datetime import datetime
 
@@ -19,6 +20,7 @@ from tools import (
 )
 from optimized_langchain_agent import OptimizedLangchainAgent
 from planner_agent import PlannerAgent
+from layout_chat import preload_layout_model
 
 # ---------------------------------------------------------------------------
 # 🌟 Helpers de concurrencia segura para conversations.json
@@ -54,6 +56,41 @@ def write_conversations(data: dict):
         os.replace(tmp_path, CONV_PATH)
 
 
+# Presupuesto (en caracteres) del historial que se reenvía a los agentes
+MAX_HISTORY_CHARS = 32_000
+# Los mensajes antiguos que no caben se conservan resumidos (su inicio) dentro de este presupuesto extra
+CONDENSED_HISTORY_CHARS = 4_000
+CONDENSED_MESSAGE_CHARS = 200
+
+
+def trim_history(chat_history: list, max_chars: int = MAX_HISTORY_CHARS) -> list:
+    """Mantiene completos los mensajes más recientes cuyo texto total quepa en ``max_chars``.
+    Se limita por tamaño y no por número de mensajes: una sola respuesta HTML puede ser enorme.
+    Los anteriores no se pierden del todo: se recortan a ``CONDENSED_MESSAGE_CHARS`` caracteres
+    (del más nuevo al más viejo) mientras quepan en ``CONDENSED_HISTORY_CHARS``.
+    """
+    total = 0
+    start = len(chat_history)
+    while start > 0:
+        total += len(str(chat_history[start - 1].get("content", "")))
+        if total > max_chars:
+            break
+        start -= 1
+
+    condensed = []
+    budget = CONDENSED_HISTORY_CHARS
+    for msg in reversed(chat_history[:start]):
+        content = str(msg.get("content", ""))
+        if len(content) > CONDENSED_MESSAGE_CHARS:
+            content = content[:CONDENSED_MESSAGE_CHARS].rstrip() + " [...]"
+        budget -= len(content)
+        if budget < 0:
+            break
+        condensed.append({**msg, "content": content})
+    condensed.reverse()
+    return condensed + chat_history[start:]
+
+
 # ---------------------------------------------------------------------------
 # Flask app
 # ---------------------------------------------------------------------------
@@ -66,6 +103,9 @@ search_agent = OptimizedLangchainAgent(
 )
 planner_agent = PlannerAgent(verbose_agent=True, max_iterations=15)
 
+# Carga el modelo de layout en Ollama en segundo plano para que la primera respuesta no espere a la carga
+threading.Thread(target=preload_layout_model, daemon=True).start()
+
 # ---------------------------------------------------------------------------
 # ENDPOINTS
 # ---------------------------------------------------------------------------
@@ -75,7 +115,7 @@ planner_agent = PlannerAgent(verbose_agent=True, max_iterations=15)
 def search():
     data = request.get_json()
     query = data.get("query")
-    chat_history = data.get("chat_history", [])
+    chat_history = trim_history(data.get("chat_history", []))
     if not query:
         return jsonify({"error": "Missing query parameter"}), 400
 
@@ -109,7 +149,7 @@ def search():
 def plan():
     data = request.get_json()
     query = data.get("query")
-    chat_history = data.get("chat_history", [])
+    chat_history = trim_history(data.get("chat_history", []))
     if not query:
         return jsonify({"error": "Missing query parameter"}), 400
 
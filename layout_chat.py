@@ -1,18 +1,471 @@
 import sys
-import base64
+import asyncio
+import functools
+import hashlib
+import html
 import io
 import os
-from typing import List, Iterator, Union, Dict, Any
+import re
+import threading
+import time
+import traceback
+import weakref
+from collections import OrderedDict
+from concurrent.futures import Future, ThreadPoolExecutor
+from html.parser import HTMLParser
+from typing import List, Iterator, AsyncIterator, Union, Dict, Any, Tuple
 
+try:
+	import pybase64 as base64 # Optional SIMD-accelerated drop-in replacement for the stdlib module
+except ImportError:
+	import base64
+
+import httpx
+import requests
 from PIL import Image # For image handling
 
 # Langchain imports
 from langchain_ollama.chat_models import ChatOllama
 from langchain_core.messages import AIMessage, AIMessageChunk, HumanMessage, SystemMessage, BaseMessage
+from ollama._client import _parse_host # Same host resolution as the client ChatOllama builds
 
 # Model names and verbose setting import
 from config import LAYOUT_MODEL, VERBOSE, IMAGES_DIR # Assuming config.py is correctly set up
 
+# PIL image format -> MIME type used in the image data URLs
+_MIME: Dict[str, str] = {
+	"JPEG": "image/jpeg",
+	"PNG": "image/png",
+	"GIF": "image/gif",
+	"WEBP": "image/webp",
+}
+
+_LAYOUT_SYSTEM_PROMPT = (
+"""You are an expert creative assistant transforming provided text and image data into exceptionally well-structured, visually appealing, engaging, and **modern HTML content**. Your output is the final product, designed for a **superior visual and textual experience**.
+
+**Core Instructions:**
+1.  **HTML Only Output:** Your entire response must be *only* the enhanced HTML content. Strictly NO `<style>` tags, inline `style` attributes, `<script>` tags, comments, preambles, or additional text.
+2.  **Content Integrity:** Maintain all factual information from 'Main Content'. Do NOT invent content, facts, or answers; only use relevant provided information.
+3.  **Semantic HTML & Dynamic Layouts:** Use *only* semantic HTML elements. Go beyond linear; strive for **varied, dynamic layouts** (e.g., card-like `<article>/<section>`, grid-like `<dl>`, side-by-side using semantic grouping like `<div>` or `<section>`) to make information intuitive and engaging. Utilize `<h1>`-`<h6>`, `<p>`, `<ul>`, `<ol>`, `<dl>`, `<strong>`, `<em>`, `<blockquote>`, `<pre><code>`, `<table>` (for tabular data), `<figure>` (with `<img>`, `alt`, `<figcaption>`), `<details>`/`<summary>`, `<a href>`, `<hr>`, `<abbr>`, `<mark>`, `<time>`.
+4.  **Visual Flow & Readability:** Break long text into shorter paragraphs. Use lists for enumerations. Employ clear heading hierarchy. Structure content to guide the eye and facilitate quick understanding.
+5.  **Image Integration (If 'Content Images' provided):** Insert images using `<figure>` (with descriptive `alt` for `<img>` and a relevant `<figcaption>`). Place images where most relevant to the text. Do NOT use text or information *within* images as content. Do NOT invent image content or use placeholders; reference ONLY provided images. Avoid repeating the same image multiple times in the output. Avoid including images of plots, posters, or other visualizations that are not directly related to the text content. If the image is not visually relevant to the text, do not include it in the output.
+6.  **Layout Inspiration (If 'Layout Inspiration Screenshots' provided):** Use *solely* for high-level structural and organizational ideas; do NOT replicate visual styling (colors, fonts, specific spacing).
+7.  **Link Handling (CRITICAL):** PRESERVE REAL, PROVIDED LINKS (`<a href="URL">Descriptive Text</a>`) EXACTLY as given in 'Main Content'. Do NOT invent, create, or generate any new, placeholder (e.g., `example.com`), or misleading links. Be meticulous with accuracy, ensuring correct URL and descriptive text from input.
+""")
+
+# Built once per process: run_layout creates a LayoutChat per request, and every run() reuses it
+_LAYOUT_SYSTEM_MESSAGE = SystemMessage(content=_LAYOUT_SYSTEM_PROMPT)
+
+# Fixed per-request instructions; kept separate from the query/content so the prompt prefix stays stable
+_LAYOUT_INSTRUCTIONS = (
+	"Please reformat and enhance the main content given at the end of this message. "
+	"Integrate context from 'content images' (if provided) and "
+	"use 'layout inspiration screenshots' (if provided) to guide the visual style. "
+	"Respond with the best format in order to answer my initial query with an understandable, clear way for me. "
+	"Only answer with the final HTML content, no additional text or explanations."
+)
+
+# Process-wide LRU of encoded images: key -> (base64, mime).
+# Shared by all LayoutChat instances, since run_layout creates a new one per request.
+_IMAGE_CACHE: "OrderedDict[tuple, Tuple[str, str]]" = OrderedDict()
+_IMAGE_CACHE_SIZE = 64
+_IMAGE_CACHE_LOCK = threading.Lock()
+
+# Process-wide LRU of final layout responses keyed by a SHA-256 of the full prompt (model, text and images),
+# storing (time.monotonic() when stored, response). Like the image cache it must outlive a LayoutChat instance.
+_RESPONSE_CACHE: "OrderedDict[str, Tuple[float, str]]" = OrderedDict()
+_RESPONSE_CACHE_SIZE = 128
+_RESPONSE_CACHE_LOCK = threading.Lock()
+
+# Shared pool for image encoding: file reads, PIL codecs and base64 all release the GIL
+_IMG_POOL = ThreadPoolExecutor(max_workers=min(8, os.cpu_count() or 1), thread_name_prefix="layout-img")
+
+
+# Per-thread scratch buffer for PIL encodes, reused across images (dropped after one grows past _SCRATCH_MAX_BYTES)
+_SCRATCH = threading.local()
+_SCRATCH_MAX_BYTES = 8 * 1024 * 1024
+
+
+def _scratch_buffer() -> io.BytesIO:
+	buffered = getattr(_SCRATCH, "buffer", None)
+	if buffered is None:
+		buffered = _SCRATCH.buffer = io.BytesIO()
+	return buffered
+
+
+def _ollama_base_url(configured_url: str | None = None) -> str:
+	"""Resolves the Ollama URL exactly like the ollama client does (OLLAMA_HOST, default scheme and port 11434)."""
+	return _parse_host(configured_url or os.getenv("OLLAMA_HOST"))
+
+
+def _check_ollama_connection(llm: ChatOllama, model_name: str, timeout: float = 2.0) -> None:
+	"""Pings Ollama's /api/tags endpoint; raises if the server is unreachable."""
+	response = requests.get(f"{_ollama_base_url(llm.base_url)}/api/tags", timeout=timeout)
+	response.raise_for_status()
+	available_models = {m.get("name") for m in response.json().get("models", [])}
+	if model_name not in available_models and f"{model_name}:latest" not in available_models:
+		print(f"Warning: Ollama layout model '{model_name}' not found in local models.", file=sys.stderr)
+
+
+def preload_layout_model(model_name: str = LAYOUT_MODEL, keep_alive: str = "30m", timeout: float = 300.0) -> None:
+	"""
+	Loads the layout model into Ollama ahead of the first layout request, so that request doesn't pay
+	the model load. An /api/generate call without a prompt only loads the model; nothing is generated.
+	Meant to be run in a background thread at server start; failures are only logged.
+	"""
+	try:
+		response = requests.post(
+			f"{_ollama_base_url()}/api/generate",
+			json={"model": model_name, "keep_alive": keep_alive},
+			timeout=timeout,
+		)
+		response.raise_for_status()
+	except Exception as e:
+		print(f"Warning: could not preload Ollama layout model '{model_name}'. Details: {e}", file=sys.stderr)
+
+
+_LLM_LOCK = threading.Lock()
+
+
+def _get_llm(model_name: str,
+		temperature: float,
+		keep_alive: str = "30m",
+		num_ctx: int | None = None,
+		num_gpu: int | None = None,
+		num_thread: int | None = None
+		) -> ChatOllama:
+	"""
+	Returns the shared ChatOllama client for a model, checking the connection on first use.
+	``keep_alive`` keeps the model loaded in Ollama between requests, so the KV cache of the
+	stable prompt prefix (system prompt + instructions) survives and isn't prefilled again.
+	``num_ctx``, ``num_gpu`` and ``num_thread`` are passed to Ollama when set (None keeps its defaults).
+	"""
+	# lru_cache alone lets concurrent first requests (threaded Flask) each build a client and ping Ollama
+	with _LLM_LOCK:
+		return _create_llm(model_name, temperature, keep_alive, num_ctx, num_gpu, num_thread)
+
+
+@functools.lru_cache(maxsize=4)
+def _create_llm(model_name: str,
+		temperature: float,
+		keep_alive: str,
+		num_ctx: int | None,
+		num_gpu: int | None,
+		num_thread: int | None
+		) -> ChatOllama:
+	llm = _build_llm(model_name, temperature, keep_alive, num_ctx, num_gpu, num_thread)
+	# Lightweight connection check against the Ollama API (no model generation)
+	_check_ollama_connection(llm, model_name)
+	return llm
+
+
+def _build_llm(model_name: str,
+		temperature: float,
+		keep_alive: str,
+		num_ctx: int | None,
+		num_gpu: int | None,
+		num_thread: int | None
+		) -> ChatOllama:
+	return ChatOllama(
+		model=model_name,
+		temperature=temperature,
+		keep_alive=keep_alive,
+		num_ctx=num_ctx,
+		num_gpu=num_gpu,
+		num_thread=num_thread,
+		# Keep idle connections to Ollama open between requests (httpx's default expiry is only 5s)
+		client_kwargs={"limits": httpx.Limits(max_keepalive_connections=10, keepalive_expiry=120.0)},
+	)
+
+
+# Event loop -> {client args -> ChatOllama}. Pooled httpx.AsyncClient connections belong to the loop
+# that opened them, so `astream` gets a client per loop; entries go away with their loop.
+_ASYNC_LLMS: "weakref.WeakKeyDictionary[asyncio.AbstractEventLoop, Dict[tuple, ChatOllama]]" = weakref.WeakKeyDictionary()
+
+
+def _get_async_llm(*llm_args: Any) -> ChatOllama:
+	"""Returns the ChatOllama to `astream` with on the running event loop (same arguments as `_get_llm`)."""
+	loop = asyncio.get_running_loop()
+	with _LLM_LOCK:
+		loop_llms = _ASYNC_LLMS.setdefault(loop, {})
+		if llm_args not in loop_llms:
+			loop_llms[llm_args] = _build_llm(*llm_args)
+		return loop_llms[llm_args]
+
+
+# Streamed tokens are coalesced into chunks of up to this many characters, or whatever arrived within the delay
+_STREAM_FLUSH_CHARS = 8192
+_STREAM_FLUSH_SECONDS = 0.025
+
+
+def _coalesce_chunks(stream: Iterator[BaseMessage]) -> Iterator[str]:
+	"""Joins tiny streamed token chunks so callers (HTTP response, file writes) handle fewer, larger pieces."""
+	buffer: List[str] = []
+	buffered_chars = 0
+	last_flush = time.monotonic()
+	for chunk in stream:
+		if not (isinstance(chunk, AIMessageChunk) and chunk.content):
+			continue
+		buffer.append(chunk.content)
+		buffered_chars += len(chunk.content)
+		if buffered_chars >= _STREAM_FLUSH_CHARS or time.monotonic() - last_flush >= _STREAM_FLUSH_SECONDS:
+			yield "".join(buffer)
+			buffer.clear()
+			buffered_chars = 0
+			last_flush = time.monotonic()
+	if buffer:
+		yield "".join(buffer)
+
+
+async def _acoalesce_chunks(stream: AsyncIterator[BaseMessage]) -> AsyncIterator[str]:
+	"""Async counterpart of `_coalesce_chunks`."""
+	buffer: List[str] = []
+	buffered_chars = 0
+	last_flush = time.monotonic()
+	async for chunk in stream:
+		if not (isinstance(chunk, AIMessageChunk) and chunk.content):
+			continue
+		buffer.append(chunk.content)
+		buffered_chars += len(chunk.content)
+		if buffered_chars >= _STREAM_FLUSH_CHARS or time.monotonic() - last_flush >= _STREAM_FLUSH_SECONDS:
+			yield "".join(buffer)
+			buffer.clear()
+			buffered_chars = 0
+			last_flush = time.monotonic()
+	if buffer:
+		yield "".join(buffer)
+
+
+def _flatten_for_jpeg(image: Image.Image) -> Image.Image:
+	"""Returns an RGB version of ``image``, pasting alpha images onto a white canvas (transparent areas become white)."""
+	if image.mode == 'P':
+		image = image.convert('RGBA') if 'transparency' in image.info else image.convert('RGB')
+	if image.mode in ('RGBA', 'LA'):
+		background = Image.new('RGB', image.size, (255, 255, 255))
+		background.paste(image, mask=image.getchannel('A'))
+		return background
+	return image if image.mode == 'RGB' else image.convert('RGB')
+
+
+def _estimate_encoded_bytes(image: Image.Image, image_format: str) -> int:
+	"""Rough upper bound of the encoded size: raw pixel size for lossless formats, 1/8 of it for JPEG."""
+	raw = image.width * image.height * len(image.getbands())
+	return max(raw // 8, 64 * 1024) if image_format == 'JPEG' else max(raw, 1)
+
+
+_MD_LINK_RE = re.compile(r'\[([^\]]+)\]\((https?://[^\s)"]+)\)')
+_THINK_RE = re.compile(r"<think>.*?</think>", re.DOTALL)
+_HTML_START_RE = re.compile(r'\s*<(?:[a-zA-Z][a-zA-Z0-9]*)[\s>/]')
+
+
+_MD_CODE_OR_LINK_RE = re.compile(r'`([^`]+)`|' + _MD_LINK_RE.pattern)
+_MD_STRONG_RE = re.compile(r'(\*\*|__)(?=\S)(.+?)(?<=\S)\1')
+_MD_EM_RE = re.compile(r'(?<![\w*])([*_])(?=\S)(.+?)(?<=\S)\1(?![\w*])')
+_ORDERED_ITEM_RE = re.compile(r'\d{1,3}[.)]\s+')
+_MD_HEADING_RE = re.compile(r'(#{1,6})\s+(.*)')
+_MD_FENCE_RE = re.compile(r'^[ \t]*(?:```|~~~)', re.MULTILINE)
+_MD_TABLE_SEPARATOR_RE = re.compile(r'^[ \t]*\|?[ \t]*:?-{3,}:?[ \t]*\|', re.MULTILINE)
+
+
+def _inline_emphasis(text: str) -> str:
+	return _MD_EM_RE.sub(r'<em>\2</em>', _MD_STRONG_RE.sub(r'<strong>\2</strong>', text))
+
+
+def _inline_html(line: str) -> str:
+	"""Escapes a line and converts inline markdown: `code`, [links](url), **strong** and *em*/_em_ (not inside code or URLs)."""
+	parts: List[str] = []
+	last = 0
+	for m in _MD_CODE_OR_LINK_RE.finditer(line):
+		parts.append(_inline_emphasis(html.escape(line[last:m.start()], quote=False)))
+		if m.group(1) is not None:
+			parts.append(f"<code>{html.escape(m.group(1), quote=False)}</code>")
+		else:
+			parts.append(f'<a href="{html.escape(m.group(3))}">{_inline_emphasis(html.escape(m.group(2), quote=False))}</a>')
+		last = m.end()
+	parts.append(_inline_emphasis(html.escape(line[last:], quote=False)))
+	return "".join(parts)
+
+
+def _is_complete_html(text: str) -> bool:
+	"""Cheap check for agent output that is already a full HTML fragment (starts and ends with tags, several closed elements)."""
+	stripped = text.strip()
+	return (stripped.startswith('<') and stripped.endswith('>') and stripped.count('</') >= 3
+			and _HTML_START_RE.match(stripped) is not None and 'example.com' not in stripped)
+
+
+# Elements dropped with their content, and void elements dropped on their own
+_UNSAFE_ELEMENTS = frozenset({"script", "style", "iframe", "object", "noscript", "template", "frameset", "svg", "math"})
+_UNSAFE_VOID_ELEMENTS = frozenset({"embed", "frame", "base", "link", "meta"})
+_URL_ATTRIBUTES = frozenset({"href", "src", "action", "formaction", "xlink:href", "poster", "background", "cite"})
+_CONTROL_AND_SPACE_RE = re.compile(r'[\x00-\x20]+')
+
+
+class _HTMLSanitizer(HTMLParser):
+	"""
+	Re-serializes HTML without script-capable elements, event handler / style attributes and
+	javascript:/vbscript:/non-image data: URLs. Attribute values are re-quoted from the parsed
+	(entity-decoded) values, so encoded variants like ``jav&#x61;script:`` are caught too.
+	"""
+	def __init__(self) -> None:
+		super().__init__(convert_charrefs=False)
+		self.parts: List[str] = []
+		self._skip_depth = 0
+
+	def _is_unsafe_url(self, value: str) -> bool:
+		url = _CONTROL_AND_SPACE_RE.sub('', html.unescape(value)).lower()
+		return url.startswith(('javascript:', 'vbscript:')) or (url.startswith('data:') and not url.startswith('data:image/'))
+
+	def _start(self, tag: str, attrs: List[Tuple[str, str | None]], self_closing: bool) -> None:
+		if tag in _UNSAFE_ELEMENTS:
+			if not self_closing:
+				self._skip_depth += 1
+			return
+		if self._skip_depth or tag in _UNSAFE_VOID_ELEMENTS:
+			return
+		kept = []
+		for name, value in attrs:
+			if name.startswith('on') or name in ('style', 'srcdoc'):
+				continue
+			if value is None:
+				kept.append(f" {name}")
+			elif not (name in _URL_ATTRIBUTES and self._is_unsafe_url(value)):
+				kept.append(f' {name}="{html.escape(value)}"')
+		self.parts.append(f"<{tag}{''.join(kept)}{' /' if self_closing else ''}>")
+
+	def handle_starttag(self, tag: str, attrs: List[Tuple[str, str | None]]) -> None:
+		self._start(tag, attrs, False)
+
+	def handle_startendtag(self, tag: str, attrs: List[Tuple[str, str | None]]) -> None:
+		self._start(tag, attrs, True)
+
+	def handle_endtag(self, tag: str) -> None:
+		if tag in _UNSAFE_ELEMENTS:
+			self._skip_depth = max(0, self._skip_depth - 1)
+		elif not self._skip_depth and tag not in _UNSAFE_VOID_ELEMENTS:
+			self.parts.append(f"</{tag}>")
+
+	def handle_data(self, data: str) -> None:
+		if not self._skip_depth:
+			self.parts.append(html.escape(data, quote=False))
+
+	def handle_entityref(self, name: str) -> None:
+		if not self._skip_depth:
+			self.parts.append(f"&{name};")
+
+	def handle_charref(self, name: str) -> None:
+		if not self._skip_depth:
+			self.parts.append(f"&#{name};")
+
+
+def _sanitize_html(text: str) -> str:
+	"""
+	Makes HTML that skips the layout model safe to render: agent output carries scraped web content,
+	and the frontend inserts the response as raw HTML. Comments and doctypes are dropped too.
+	"""
+	sanitizer = _HTMLSanitizer()
+	sanitizer.feed(text)
+	sanitizer.close()
+	return "".join(sanitizer.parts).strip()
+
+
+def _code_block_html(lines: List[str]) -> str:
+	return "<pre><code>" + html.escape("\n".join(lines), quote=False) + "</code></pre>"
+
+
+def _local_htmlize(text: str) -> str:
+	"""Minimal local text -> HTML formatter (headings, paragraphs, bullet and numbered lists, fenced code, inline markdown) for short outputs."""
+	if _HTML_START_RE.match(text): # Already HTML: escaping it would show the tags as text
+		return _sanitize_html(text)
+	html_parts: List[str] = []
+	paragraph: List[str] = []
+	items: List[str] = []
+	list_tag = "ul"
+	code_lines: List[str] | None = None # Lines of the open fenced code block, if any
+
+	def flush() -> None:
+		if paragraph:
+			html_parts.append(f"<p>{' '.join(paragraph)}</p>")
+			paragraph.clear()
+		if items:
+			html_parts.append(f"<{list_tag}>" + "".join(f"<li>{item}</li>" for item in items) + f"</{list_tag}>")
+			items.clear()
+
+	for raw_line in text.splitlines():
+		line = raw_line.strip()
+		if code_lines is not None:
+			if line.startswith(('```', '~~~')):
+				html_parts.append(_code_block_html(code_lines))
+				code_lines = None
+			else:
+				code_lines.append(raw_line)
+		elif line.startswith(('```', '~~~')):
+			flush()
+			code_lines = []
+		elif not line:
+			flush()
+		elif line.startswith(('- ', '* ')) or _ORDERED_ITEM_RE.match(line):
+			ordered = not line.startswith(('- ', '* '))
+			if paragraph or (items and list_tag != ("ol" if ordered else "ul")): flush()
+			list_tag = "ol" if ordered else "ul"
+			item = line[_ORDERED_ITEM_RE.match(line).end():] if ordered else line[2:]
+			items.append(_inline_html(item.strip()))
+		elif _MD_HEADING_RE.match(line):
+			flush()
+			heading = _MD_HEADING_RE.match(line)
+			level = len(heading.group(1))
+			html_parts.append(f"<h{level}>{_inline_html(heading.group(2).strip())}</h{level}>")
+		else:
+			if items: flush()
+			paragraph.append(_inline_html(line))
+	flush()
+	if code_lines is not None: # Unclosed fence: keep the code as code
+		html_parts.append(_code_block_html(code_lines))
+	return "\n".join(html_parts)
+
+
+def _sniff_mime(data: bytes) -> str | None:
+	"""Returns the MIME type of encoded image bytes from their magic number, or None if not a supported format."""
+	if data[:3] == b'\xff\xd8\xff':
+		return "image/jpeg"
+	if data[:8] == b'\x89PNG\r\n\x1a\n':
+		return "image/png"
+	if data[:4] == b'RIFF' and data[8:12] == b'WEBP':
+		return "image/webp"
+	if data[:6] in (b'GIF87a', b'GIF89a'):
+		return "image/gif"
+	return None
+
+
+@functools.lru_cache(maxsize=256)
+def _probe_image_file(abspath: str, mtime_ns: int, file_size: int) -> Tuple[str | None, Tuple[int, int], str | None]:
+	"""
+	Returns (sniffed MIME type, pixel size, PIL format) of an image file, reading only its header.
+	Cached process-wide; mtime and size are part of the key so modified files are probed again.
+	"""
+	with open(abspath, 'rb') as f:
+		mime_type = _sniff_mime(f.read(12))
+		f.seek(0)
+		with Image.open(f) as image: # Same file handle; lazy open, so only the header is parsed
+			return mime_type, image.size, image.format
+
+
+def _dhash(image: Image.Image) -> int:
+	"""64-bit difference hash: sign of horizontal gradients on a 9x8 grayscale thumbnail."""
+	pixels = list(image.convert('L').resize((9, 8), Image.Resampling.BILINEAR).getdata())
+	bits = 0
+	for row in range(8):
+		for col in range(8):
+			bits = (bits << 1) | (pixels[row * 9 + col] > pixels[row * 9 + col + 1])
+	return bits
+
+
+@functools.lru_cache(maxsize=256)
+def _dhash_file(abspath: str, mtime_ns: int, file_size: int) -> int:
+	"""`_dhash` of an image file, cached process-wide by path, mtime and size."""
+	with Image.open(abspath) as image:
+		image.draft('L', (64, 64)) # JPEG only: decode at reduced scale, a no-op for other formats
+		return _dhash(image)
+
 
 class LayoutChat:
 	"""
@@ -23,119 +476,216 @@ class LayoutChat:
 	def __init__(self,
 			layout_model_name: str = LAYOUT_MODEL,
 			verbose: bool = VERBOSE,
+			cache_enabled: bool = True,
+			cache_ttl_seconds: float = 3600.0,
+			max_image_side: int = 1024,
+			max_layout_image_side: int = 768,
+			max_input_chars: int = 24000,
+			fastpath_threshold_chars: int = 500,
+			keep_alive: str = "30m",
+			skip_if_html: bool = True,
+			num_ctx: int | None = None,
+			num_gpu: int | None = None,
+			num_thread: int | None = None,
 		):
 		self.layout_model_name = layout_model_name
 		self.verbose = verbose
+		self.cache_enabled = cache_enabled
+		self.cache_ttl_seconds = cache_ttl_seconds # Answers about news/weather go stale, so cached layouts expire
+		self.max_image_side = max_image_side # Larger images are downscaled before being sent to the model
+		self.max_layout_image_side = max_layout_image_side # Layout screenshots are only style guidance, so they get a lower limit
+		self.max_input_chars = max_input_chars # Longer agent outputs are truncated (~6k tokens by default)
+		self.fastpath_threshold_chars = fastpath_threshold_chars # Shorter, image-less outputs skip the LLM (0 disables)
+		self.skip_if_html = skip_if_html # Agent output that is already HTML (and has no content images) skips the LLM
 
 		try:
-			self.llm = ChatOllama(model=self.layout_model_name, temperature=0.2)
-			# Simple connection check (invoke with a short text)
-			_ = self.llm.invoke("Connection test.")
+			# Shared per (model, temperature): one client and one connection check per process
+			self._llm_args = (self.layout_model_name, 0.2, keep_alive, num_ctx, num_gpu, num_thread)
+			self.llm = _get_llm(*self._llm_args)
 			if self.verbose:
 				print(f"Successfully connected to Ollama layout model '{self.layout_model_name}'.")
 		except Exception as e:
 			print(f"Error initializing/connecting to Ollama layout model '{self.layout_model_name}'. Details: {e}", file=sys.stderr)
 			sys.exit(1)
 
-		self.system_message: str = (
-"""You are an expert creative assistant transforming provided text and image data into exceptionally well-structured, visually appealing, engaging, and **modern HTML content**. Your output is the final product, designed for a **superior visual and textual experience**.
+		self.system_message: str = _LAYOUT_SYSTEM_PROMPT
+		self._system_msg = _LAYOUT_SYSTEM_MESSAGE
 
-**Core Instructions:**
-1.  **HTML Only Output:** Your entire response must be *only* the enhanced HTML content. Strictly NO `<style>` tags, inline `style` attributes, `<script>` tags, comments, preambles, or additional text.
-2.  **Content Integrity:** Maintain all factual information from 'Main Content'. Do NOT invent content, facts, or answers; only use relevant provided information.
-3.  **Semantic HTML & Dynamic Layouts:** Use *only* semantic HTML elements. Go beyond linear; strive for **varied, dynamic layouts** (e.g., card-like `<article>/<section>`, grid-like `<dl>`, side-by-side using semantic grouping like `<div>` or `<section>`) to make information intuitive and engaging. Utilize `<h1>`-`<h6>`, `<p>`, `<ul>`, `<ol>`, `<dl>`, `<strong>`, `<em>`, `<blockquote>`, `<pre><code>`, `<table>` (for tabular data), `<figure>` (with `<img>`, `alt`, `<figcaption>`), `<details>`/`<summary>`, `<a href>`, `<hr>`, `<abbr>`, `<mark>`, `<time>`.
-4.  **Visual Flow & Readability:** Break long text into shorter paragraphs. Use lists for enumerations. Employ clear heading hierarchy. Structure content to guide the eye and facilitate quick understanding.
-5.  **Image Integration (If 'Content Images' provided):** Insert images using `<figure>` (with descriptive `alt` for `<img>` and a relevant `<figcaption>`). Place images where most relevant to the text. Do NOT use text or information *within* images as content. Do NOT invent image content or use placeholders; reference ONLY provided images. Avoid repeating the same image multiple times in the output. Avoid including images of plots, posters, or other visualizations that are not directly related to the text content. If the image is not visually relevant to the text, do not include it in the output.
-6.  **Layout Inspiration (If 'Layout Inspiration Screenshots' provided):** Use *solely* for high-level structural and organizational ideas; do NOT replicate visual styling (colors, fonts, specific spacing).
-7.  **Link Handling (CRITICAL):** PRESERVE REAL, PROVIDED LINKS (`<a href="URL">Descriptive Text</a>`) EXACTLY as given in 'Main Content'. Do NOT invent, create, or generate any new, placeholder (e.g., `example.com`), or misleading links. Be meticulous with accuracy, ensuring correct URL and descriptive text from input.
-""")
 
 
+	def _encode_pil_image(self, image: Image.Image, force_format: str | None = None, max_side: int | None = None) -> Tuple[str, str]:
+		"""
+		Encodes a PIL image to base64 and returns it with its MIME type.
+		Uses ``force_format`` if given, otherwise the image's own format (PNG if unsupported).
+		Images larger than ``max_side`` (default: max_image_side) are downscaled first.
+		"""
+		max_side = max_side or self.max_image_side
+		image_format = (force_format or image.format or 'PNG').upper()
+		if image_format == 'MPO': # Multi-picture JPEG (most camera photos): keep it JPEG rather than bloating it to PNG
+			image_format = 'JPEG'
+		if image_format not in _MIME: # Re-encode unknown formats as PNG so data and MIME type agree
+			image_format = 'PNG'
+		if max(image.size) > max_side: # resize() returns a copy, the caller's image is left untouched
+			scale = max_side / max(image.size)
+			new_size = (max(1, round(image.width * scale)), max(1, round(image.height * scale)))
+			image = image.resize(new_size, Image.Resampling.LANCZOS)
+			# A downscaled photo re-encoded as PNG stays huge; only flat graphics (<= 256 colors) compress well as PNG
+			if not force_format and image_format == 'PNG' and image.getcolors(256) is None:
+				image_format = 'JPEG'
+		save_kwargs: Dict[str, Any] = {}
+		if image_format == 'JPEG':
+			if image.mode not in ('RGB', 'L'): # JPEG doesn't support alpha or palettes
+				image = _flatten_for_jpeg(image)
+			if force_format:
+				save_kwargs = {"quality": 75, "optimize": False, "progressive": False}
+			else:
+				save_kwargs = {"quality": 85}
+		buffered = _scratch_buffer()
+		# Grow the (reused) buffer only if it's smaller than this image needs, never while PIL writes into it
+		estimated_size = _estimate_encoded_bytes(image, image_format)
+		if buffered.seek(0, io.SEEK_END) < estimated_size:
+			buffered.seek(estimated_size - 1)
+			buffered.write(b"\0")
+		buffered.seek(0)
+		image.save(buffered, format=image_format, **save_kwargs)
+		encoded_size = buffered.tell() # Bytes past this point are leftovers from earlier images
+		# getbuffer() is a zero-copy view; base64 output is pure ASCII
+		with buffered.getbuffer() as view, view[:encoded_size] as encoded:
+			encoded_b64 = base64.b64encode(encoded).decode('ascii')
+		if buffered.seek(0, io.SEEK_END) > _SCRATCH_MAX_BYTES: # Don't keep an exceptional peak alive per thread
+			_SCRATCH.buffer = None
+		return encoded_b64, _MIME[image_format]
+
+	def _image_cache_key(self, image_input: Union[str, Image.Image], max_side: int) -> tuple:
+		"""
+		Cache key for an image: path + mtime + size for files, a digest of the pixel data for PIL objects
+		(callers may edit an image in place between calls, so its identity says nothing about its content).
+		Includes the size limit, since the shared cache serves every LayoutChat instance.
+		"""
+		if isinstance(image_input, str):
+			st = os.stat(image_input)
+			return ("path", os.path.abspath(image_input), st.st_mtime_ns, st.st_size, max_side)
+		h = hashlib.blake2b(image_input.tobytes(), digest_size=16)
+		if image_input.mode in ('P', 'PA'): # Palette images: the pixels are only indices
+			h.update(bytes(image_input.getpalette() or ()))
+		return ("pil", h.digest(), image_input.size, image_input.mode, image_input.format, max_side)
+
+	def _encode_and_mime(self,
+			image_input: Union[str, Image.Image],
+			force_format: str | None = None,
+			key: tuple | None = None,
+			max_side: int | None = None
+			) -> Tuple[str, str]:
+		"""
+		Encodes an image to base64 and determines its MIME type, opening (and stat-ing) it only once.
+		``force_format`` (e.g. 'JPEG') re-encodes the image into that format.
+		``key`` is the precomputed cache key (`_image_cache_key` + force_format), if the caller already has it.
+		``max_side`` overrides max_image_side as the downscaling limit.
+		Results are cached; an empty base64 string means the image could not be processed.
+		"""
+		max_side = max_side or self.max_image_side
+		if key is None:
+			try:
+				key = self._image_cache_key(image_input, max_side) + (force_format,)
+			except Exception:
+				key = None
+		if key is not None:
+			with _IMAGE_CACHE_LOCK:
+				cached = _IMAGE_CACHE.get(key)
+				if cached is not None:
+					_IMAGE_CACHE.move_to_end(key)
+					return cached
 
-	def _encode_image(self, image_input: Union[str, Image.Image]) -> str:
-		"""Encodes an image to base64."""
 		try:
 			if isinstance(image_input, str): # Path to image
-				image = Image.open(image_input)
+				if key is None: # Key couldn't be built; stat again so the real error is reported below
+					st = os.stat(image_input)
+					abspath, mtime_ns, file_size = os.path.abspath(image_input), st.st_mtime_ns, st.st_size
+				else:
+					_, abspath, mtime_ns, file_size = key[:4]
+				mime_type, pixel_size, image_format = _probe_image_file(abspath, mtime_ns, file_size)
+				# Compare sniffed MIME types rather than PIL format names: PIL reports many camera JPEGs as 'MPO'
+				if mime_type and max(pixel_size) <= max_side and (not force_format or _MIME.get(force_format) == mime_type):
+					# Already a supported format and size: send the file bytes as-is, no decode/re-encode
+					with open(abspath, 'rb') as f:
+						result = (base64.b64encode(f.read()).decode('ascii'), mime_type)
+				else:
+					with Image.open(abspath) as image:
+						result = self._encode_pil_image(image, force_format, max_side)
 			elif isinstance(image_input, Image.Image):
-				image = image_input
+				result = self._encode_pil_image(image_input, force_format, max_side)
 			else:
 				raise ValueError("Invalid image_input type. Must be str (path) or PIL.Image.Image.")
-
-			buffered = io.BytesIO()
-			image_format = image.format if image.format else 'PNG' # Default to PNG if format not discernible
-			if image.mode == 'RGBA' and image_format == 'JPEG': # JPEG doesn't support alpha
-				image = image.convert('RGB')
-			image.save(buffered, format=image_format)
-			return base64.b64encode(buffered.getvalue()).decode('utf-8')
 		except FileNotFoundError:
 			if self.verbose:
 				print(f"Error encoding image: File not found - {image_input}", file=sys.stderr)
-			return ""
+			return "", "image/png"
 		except Exception as e:
 			if self.verbose:
 				print(f"Error encoding image ({type(image_input).__name__}): {e}", file=sys.stderr)
-			return ""
+			return "", "image/png"
 
-	def _get_image_mime_type(self, image_input: Union[str, Image.Image]) -> str:
-		"""Determines the MIME type of an image."""
-		try:
-			if isinstance(image_input, str):
-				image = Image.open(image_input)
-			elif isinstance(image_input, Image.Image):
-				image = image_input
+		if key is not None:
+			with _IMAGE_CACHE_LOCK:
+				_IMAGE_CACHE[key] = result
+				if len(_IMAGE_CACHE) > _IMAGE_CACHE_SIZE:
+					_IMAGE_CACHE.popitem(last=False)
+		return result
+
+	def _submit_image_encodes(self,
+			content_images: List[Union[str, Image.Image]],
+			layout_inspiration_screenshots: List[Union[str, Image.Image]]
+			) -> Tuple[List[Future], List[Future]]:
+		"""
+		Submits every distinct image once to the encoding pool (duplicates share a future).
+		Returns the per-slot futures for the layout screenshots and the content images.
+		"""
+		submitted: Dict[tuple, Future] = {}
+
+		def submit(image_input: Union[str, Image.Image], force_format: str | None, max_side: int) -> Future:
+			if isinstance(image_input, Image.Image): # Digesting the pixels is left to the pool thread
+				key = None
 			else:
-				return "image/png" # Default
-
-			img_format = image.format
-			if img_format == "JPEG":
-				return "image/jpeg"
-			elif img_format == "PNG":
-				return "image/png"
-			elif img_format == "GIF":
-				return "image/gif"
-			elif img_format == "WEBP":
-				return "image/webp"
-			else: # Add more formats if needed or default
-				return "image/png"
-		except:
-			return "image/png" # Default on error
-		
+				try:
+					key = self._image_cache_key(image_input, max_side) + (force_format,)
+				except Exception: # e.g. missing file: let _encode_and_mime report it
+					key = None
+			dedupe_key = key if key is not None else ("unkeyed", id(image_input), force_format, max_side)
+			if dedupe_key not in submitted:
+				submitted[dedupe_key] = _IMG_POOL.submit(self._encode_and_mime, image_input, force_format, key, max_side)
+			return submitted[dedupe_key]
+
+		# Layout screenshots are only style guidance, so they are sent as (much smaller) downscaled JPEGs
+		layout_futures = [submit(image_input, 'JPEG', self.max_layout_image_side) for image_input in layout_inspiration_screenshots]
+		content_futures = [submit(image_input, None, self.max_image_side) for image_input in content_images]
+		return layout_futures, content_futures
+
+	def _response_cache_key(self, human_message_content: List[Dict[str, Any]]) -> str:
+		"""SHA-256 over the model name and every text/image part of the prompt."""
+		h = hashlib.sha256(self.layout_model_name.encode("utf-8"))
+		for part in human_message_content:
+			for field in ("text", "mime_type", "data"):
+				if field in part:
+					h.update(b"\x00" + field.encode("ascii") + b"\x00" + part[field].encode("utf-8"))
+		return h.hexdigest()
+
 	def _filter_agent_output(self, agent_output_str: str) -> str:
 		"""
 		Filters the agent output string to remove the content in <think> to </think> tags.
+		Removes every block in a single pass (reasoning models may emit several).
 		"""
-		start_tag = "<think>"
-		end_tag = "</think>"
-		start_index = agent_output_str.find(start_tag)
-		end_index = agent_output_str.find(end_tag, start_index + len(start_tag))
-
-		if start_index != -1 and end_index != -1:
-			# Remove the content between <think> and </think>
-			return agent_output_str[:start_index] + agent_output_str[end_index + len(end_tag):]
-		return agent_output_str
+		if "<think>" not in agent_output_str:
+			return agent_output_str
+		return _THINK_RE.sub("", agent_output_str)
 
 
-	def run(self,
+	def _prepare_inputs(self,
 			agent_output_str: str,
 			user_original_query: str,
 			content_images: List[Union[str, Image.Image]] = None,
 			layout_inspiration_screenshots: List[Union[str, Image.Image]] = None
-			) -> Iterator[str]:
-		"""
-		Receives pre-generated text output and optional images, then uses the
-		LAYOUT_MODEL to enhance and reformat the text, incorporating image context
-		and layout inspiration.
-
-		Args:
-			agent_output_str: The string output from a previous agent/model.
-			user_original_query: The user's original query for context.
-			content_images: A list of image file paths or PIL Image objects directly related to the content.
-			layout_inspiration_screenshots: A list of image file paths or PIL Image objects for layout style guidance.
-
-		Yields:
-			str: Chunks of the formatted response from the LAYOUT_MODEL.
-		"""
+			) -> Tuple[str, List[Union[str, Image.Image]], List[Union[str, Image.Image]]]:
+		"""Logs the inputs, strips <think> blocks and limits the images. Shared by `run` and `arun`."""
 		if self.verbose:
 			print(f"\n--- LayoutChat: Received Agent Output (length: {len(agent_output_str)}) ---")
 			print(f"--- LayoutChat: Original User Query: {user_original_query} ---")
@@ -153,25 +703,86 @@ class LayoutChat:
 			print(f"--- LayoutChat: Filtered Agent Output to remove <think> tags (length: {len(agent_output_str)}) ---")
 
 		# Limit images
-		layout_inspiration_screenshots = layout_inspiration_screenshots[:2] # Limit to first 2 screenshots
-		content_images = content_images[:4] # Limit to first 4 images
-		
-		# Initialize human message content list
-		human_message_content: List[Dict[str, Any]] = []
+		layout_inspiration_screenshots = self._distinct_screenshots(layout_inspiration_screenshots or [], 2) # Up to 2 distinct screenshots
+		content_images = (content_images or [])[:4] # Limit to first 4 images
+		return agent_output_str, content_images, layout_inspiration_screenshots
 
-		# --- NEW ORDERING STARTS HERE ---
+	def _truncate_for_prompt(self, agent_output_str: str) -> str:
+		"""
+		Bounds the prompt size: keeps the start and the end (conclusion, sources) of oversized agent output,
+		cutting both parts at paragraph breaks. Only applied to text sent to the layout model.
+		"""
+		if len(agent_output_str) > self.max_input_chars:
+			original_length = len(agent_output_str)
+			head_budget = self.max_input_chars * 3 // 4
+			head_end = agent_output_str.rfind("\n\n", 0, head_budget)
+			if head_end <= 0:
+				head_end = head_budget
+			tail_start = agent_output_str.find("\n\n", original_length - (self.max_input_chars - head_budget))
+			if tail_start == -1 or tail_start <= head_end:
+				tail_start = original_length
+			agent_output_str = (agent_output_str[:head_end] + "\n\n[...truncated for layout...]"
+					+ agent_output_str[tail_start:])
+			if self.verbose:
+				print(f"--- LayoutChat: Truncated Agent Output from {original_length} to {len(agent_output_str)} characters ---")
+		return agent_output_str
+
+	def _distinct_screenshots(self, screenshots: List[Union[str, Image.Image]], limit: int) -> List[Union[str, Image.Image]]:
+		"""
+		Returns up to ``limit`` screenshots, skipping near-duplicates of an already kept one
+		(perceptual hash Hamming distance < 10), since each extra image costs a full vision prefill.
+		Screenshots that can't be hashed are kept and left for the encoder to report.
+		"""
+		kept: List[Union[str, Image.Image]] = []
+		kept_hashes: List[int] = []
+		for screenshot in screenshots:
+			if len(kept) >= limit:
+				break
+			try:
+				if isinstance(screenshot, str):
+					st = os.stat(screenshot)
+					image_hash = _dhash_file(os.path.abspath(screenshot), st.st_mtime_ns, st.st_size)
+				else:
+					image_hash = _dhash(screenshot)
+			except Exception:
+				kept.append(screenshot)
+				continue
+			if any(bin(image_hash ^ other).count("1") < 10 for other in kept_hashes):
+				if self.verbose: print("--- LayoutChat: Skipping near-duplicate layout inspiration screenshot ---")
+				continue
+			kept.append(screenshot)
+			kept_hashes.append(image_hash)
+		return kept
+
+	def _build_messages(self,
+			agent_output_str: str,
+			user_original_query: str,
+			content_images: List[Union[str, Image.Image]],
+			layout_results: List[Tuple[str, str]],
+			content_results: List[Tuple[str, str]]
+			) -> Tuple[List[BaseMessage], str | None]:
+		"""
+		Builds the messages for the layout model from the encoded (base64, mime) images.
+		Returns the messages and their response-cache key (None if caching is disabled).
+		"""
+		# Initialize human message content list. Static instructions go first so that, together with the
+		# system prompt, they form a byte-identical prefix across calls that Ollama can reuse from its KV cache.
+		human_message_content: List[Dict[str, Any]] = [{"type": "text", "text": _LAYOUT_INSTRUCTIONS}]
+
+		# Order from most to least stable: layout screenshots, content images, then query and main content
 
 		# Add layout inspiration screenshots first
-		if layout_inspiration_screenshots:
+		if layout_results:
 			processed_layout_screenshots = 0
 			human_message_content.append({"type": "text", "text": "\n\n--- Layout Inspiration Screenshots (for visual style guidance only) ---"})
-			for i, image_input in enumerate(layout_inspiration_screenshots):
-				base64_image = self._encode_image(image_input)
-				mime_type = self._get_image_mime_type(image_input)
+			for i, (base64_image, mime_type) in enumerate(layout_results):
 				if base64_image:
+					# Same base64 block as content images: no multi-MB data URL is built only for Ollama to split it again
 					human_message_content.append({
-						"type": "image_url",
-						"image_url": {"url": f"data:{mime_type};base64,{base64_image}"}
+						"type": "image",
+						"source_type": "base64",
+						"mime_type": mime_type,
+						"data": base64_image
 					})
 					human_message_content.append({"type": "text", "text": f"[Layout Inspiration Screenshot {i+1} provided for style]"})
 					processed_layout_screenshots += 1
@@ -181,13 +792,15 @@ class LayoutChat:
 			if self.verbose and processed_layout_screenshots > 0: print(f"--- LayoutChat: Added {processed_layout_screenshots} layout inspiration screenshots to prompt ---")
 
 		# Add content images second
-		if content_images:
+		if content_results:
 			processed_content_images = 0
+			first_slot_by_data: Dict[str, int] = {} # Identical images are sent once; each copy would cost vision tokens again
 			human_message_content.append({"type": "text", "text": "\n\n--- Content Images (for integration) ---"})
-			for i, image_input in enumerate(content_images):
-				base64_image = self._encode_image(image_input)
-				mime_type = self._get_image_mime_type(image_input)
-				if base64_image:
+			for i, (image_input, (base64_image, mime_type)) in enumerate(zip(content_images, content_results)):
+				if base64_image and base64_image in first_slot_by_data:
+					human_message_content.append({"type": "text", "text": f"[Content Image {i+1} is the same image as Content Image {first_slot_by_data[base64_image]}; not repeated.]"})
+				elif base64_image:
+					first_slot_by_data[base64_image] = i + 1
 					# Use image type for direct embedding in the prompt
 					human_message_content.append({
 						"type": "image",
@@ -211,57 +824,222 @@ class LayoutChat:
 					human_message_content.append({"type": "text", "text": f"[Note: Content Image {i+1} could not be processed.]"})
 			if self.verbose and processed_content_images > 0: print(f"--- LayoutChat: Added {processed_content_images} content images to prompt ---")
 
-		# Add the main text content last
+		# Add the volatile query and main text content last
 		human_message_content.append(
 			{
 				"type": "text",
 				"text": (
-					f"Please reformat and enhance the following main content. "
-					f"The original user query was: '{user_original_query}'. "
-					f"Integrate context from 'content images' (if provided) and "
-					f"use 'layout inspiration screenshots' (if provided) to guide the visual style. "
-					f"Respond with the best format in order to answer my initial query with an understandable, clear way for me."
-					f"Only answer with the final HTML content, no additional text or explanations.\n\n"
+					f"\n\nThe original user query was: '{user_original_query}'.\n\n"
 					f"Main Content:\n---\n{agent_output_str}\n---"
 				)
 			}
 		)
 
-		# --- NEW ORDERING ENDS HERE ---
+		# Construct the full list of messages for the layout model. Text-only prompts are sent as a
+		# plain string (joined like langchain-ollama joins text parts), skipping the multimodal part handling.
+		if all(part["type"] == "text" for part in human_message_content):
+			human_message = HumanMessage(content="\n".join(part["text"] for part in human_message_content))
+		else:
+			human_message = HumanMessage(content=human_message_content)
+		messages_for_layout_llm: List[BaseMessage] = [self._system_msg, human_message]
+
+		cache_key = self._response_cache_key(human_message_content) if self.cache_enabled else None
+		return messages_for_layout_llm, cache_key
 
+	def _local_response(self, agent_output_str: str, content_images: list, layout_inspiration_screenshots: list) -> str | None:
+		"""
+		Returns the final response when the layout model can be skipped, otherwise None:
+		short text-only outputs are formatted locally, and (if skip_if_html) outputs that are
+		already complete HTML without content images to place are passed through after sanitizing.
+		"""
+		# Code blocks and tables need real layout, so those go to the model even when short
+		if (not content_images and not layout_inspiration_screenshots
+				and len(agent_output_str) < self.fastpath_threshold_chars
+				and not _MD_FENCE_RE.search(agent_output_str) and not _MD_TABLE_SEPARATOR_RE.search(agent_output_str)):
+			if self.verbose: print("--- LayoutChat: Short text-only output, formatting locally without the layout model ---")
+			return _local_htmlize(agent_output_str)
+		if self.skip_if_html and not content_images and _is_complete_html(agent_output_str):
+			if self.verbose: print("--- LayoutChat: Agent output is already HTML, skipping the layout model ---")
+			return _sanitize_html(agent_output_str)
+		return None
 
-		# Construct the full list of messages for the layout model
-		messages_for_layout_llm: List[BaseMessage] = [
-			SystemMessage(content=self.system_message)
-		]
-		messages_for_layout_llm.append(HumanMessage(content=human_message_content))
+	def _get_cached_response(self, cache_key: str | None) -> str | None:
+		if cache_key is None:
+			return None
+		with _RESPONSE_CACHE_LOCK:
+			entry = _RESPONSE_CACHE.get(cache_key)
+			if entry is None:
+				return None
+			stored_at, cached_response = entry
+			if time.monotonic() - stored_at > self.cache_ttl_seconds:
+				del _RESPONSE_CACHE[cache_key]
+				return None
+			_RESPONSE_CACHE.move_to_end(cache_key)
+		if self.verbose: print(f"--- LayoutChat: Response cache hit (length: {len(cached_response)}) ---")
+		return cached_response
 
+	def _finish_response(self, cache_key: str | None, final_response_str: str) -> None:
+		"""Stores a completed response in the cache and logs it."""
+		if cache_key is not None and final_response_str:
+			with _RESPONSE_CACHE_LOCK:
+				_RESPONSE_CACHE[cache_key] = (time.monotonic(), final_response_str)
+				_RESPONSE_CACHE.move_to_end(cache_key)
+				if len(_RESPONSE_CACHE) > _RESPONSE_CACHE_SIZE:
+					_RESPONSE_CACHE.popitem(last=False)
+
+		if self.verbose:
+			print(f"\n--- LayoutChat: Final response from {self.layout_model_name} (length: {len(final_response_str)}) ---")
+			print(final_response_str)
+
+	def _streaming_error(self, error: Exception) -> str:
+		"""Builds the error chunk shown to the user when streaming fails (printing the traceback if verbose)."""
+		if self.verbose:
+			traceback.print_exc(file=sys.stderr)
+		return f"[LayoutChat Error: Error during layout model streaming: {error}]"
+
+	def run(self,
+			agent_output_str: str,
+			user_original_query: str,
+			content_images: List[Union[str, Image.Image]] = None,
+			layout_inspiration_screenshots: List[Union[str, Image.Image]] = None
+			) -> Iterator[str]:
+		"""
+		Receives pre-generated text output and optional images, then uses the
+		LAYOUT_MODEL to enhance and reformat the text, incorporating image context
+		and layout inspiration.
+
+		Args:
+			agent_output_str: The string output from a previous agent/model.
+			user_original_query: The user's original query for context.
+			content_images: A list of image file paths or PIL Image objects directly related to the content.
+			layout_inspiration_screenshots: A list of image file paths or PIL Image objects for layout style guidance.
+
+		Yields:
+			str: Chunks of the formatted response from the LAYOUT_MODEL.
+		"""
+		agent_output_str, content_images, layout_inspiration_screenshots = self._prepare_inputs(
+			agent_output_str, user_original_query, content_images, layout_inspiration_screenshots
+		)
+
+		formatted = self._local_response(agent_output_str, content_images, layout_inspiration_screenshots)
+		if formatted is not None:
+			for start in range(0, len(formatted), 256):
+				yield formatted[start:start + 256]
+			return
+
+		agent_output_str = self._truncate_for_prompt(agent_output_str)
+		# Encode all distinct images concurrently; results are collected in order
+		layout_futures, content_futures = self._submit_image_encodes(content_images, layout_inspiration_screenshots)
+
+		messages_for_layout_llm, cache_key = self._build_messages(
+			agent_output_str, user_original_query, content_images,
+			[future.result() for future in layout_futures],
+			[future.result() for future in content_futures],
+		)
+
+		# Serve repeated requests from the response cache, still streamed in chunks
+		cached_response = self._get_cached_response(cache_key)
+		if cached_response is not None:
+			for start in range(0, len(cached_response), 256):
+				yield cached_response[start:start + 256]
+			return
 
 		# 2. Stream response from LAYOUT_MODEL
 		if self.verbose: print(f"--- LayoutChat: Streaming final response from {self.layout_model_name} ---")
-		full_layout_response_content = []
+		# The full text is only needed to cache it or to print it
+		full_layout_response_content = io.StringIO() if cache_key is not None or self.verbose else None
 		try:
-			for chunk in self.llm.stream(messages_for_layout_llm):
-				if isinstance(chunk, AIMessageChunk) and chunk.content:
-					yield chunk.content
-					full_layout_response_content.append(chunk.content)
+			for text in _coalesce_chunks(self.llm.stream(messages_for_layout_llm)):
+				yield text
+				if full_layout_response_content is not None:
+					full_layout_response_content.write(text)
 
-			final_response_str = "".join(full_layout_response_content)
+			if full_layout_response_content is not None:
+				self._finish_response(cache_key, full_layout_response_content.getvalue())
 
-			if self.verbose:
-				print(f"\n--- LayoutChat: Final response from {self.layout_model_name} (length: {len(final_response_str)}) ---")
-				print(final_response_str)
+		except Exception as e:
+			yield self._streaming_error(e)
+			return
+
+		if self.verbose: print("\n--- LayoutChat: Processing Complete ---")
+
+	async def arun(self,
+			agent_output_str: str,
+			user_original_query: str,
+			content_images: List[Union[str, Image.Image]] = None,
+			layout_inspiration_screenshots: List[Union[str, Image.Image]] = None
+			) -> AsyncIterator[str]:
+		"""
+		Async counterpart of `run`: encodes images in the shared thread pool and streams the
+		LAYOUT_MODEL response with `astream`, so one event loop can serve many layout requests.
+
+		Yields:
+			str: Chunks of the formatted response from the LAYOUT_MODEL.
+		"""
+		# Screenshot de-duplication decodes images, so keep it (and the text filtering) off the event loop
+		agent_output_str, content_images, layout_inspiration_screenshots = await asyncio.get_running_loop().run_in_executor(
+			_IMG_POOL, self._prepare_inputs, agent_output_str, user_original_query, content_images, layout_inspiration_screenshots
+		)
+
+		formatted = self._local_response(agent_output_str, content_images, layout_inspiration_screenshots)
+		if formatted is not None:
+			for start in range(0, len(formatted), 256):
+				yield formatted[start:start + 256]
+			return
+
+		agent_output_str = self._truncate_for_prompt(agent_output_str)
+		layout_futures, content_futures = self._submit_image_encodes(content_images, layout_inspiration_screenshots)
+		layout_results, content_results = await asyncio.gather(
+			asyncio.gather(*(asyncio.wrap_future(future) for future in layout_futures)),
+			asyncio.gather(*(asyncio.wrap_future(future) for future in content_futures)),
+		)
+
+		messages_for_layout_llm, cache_key = self._build_messages(
+			agent_output_str, user_original_query, content_images, list(layout_results), list(content_results)
+		)
+
+		cached_response = self._get_cached_response(cache_key)
+		if cached_response is not None:
+			for start in range(0, len(cached_response), 256):
+				yield cached_response[start:start + 256]
+			return
+
+		if self.verbose: print(f"--- LayoutChat: Streaming final response from {self.layout_model_name} (async) ---")
+		# The full text is only needed to cache it or to print it
+		full_layout_response_content = io.StringIO() if cache_key is not None or self.verbose else None
+		try:
+			# Not self.llm: its async connections would be reused across event loops (e.g. successive asyncio.run calls)
+			async for text in _acoalesce_chunks(_get_async_llm(*self._llm_args).astream(messages_for_layout_llm)):
+				yield text
+				if full_layout_response_content is not None:
+					full_layout_response_content.write(text)
+
+			if full_layout_response_content is not None:
+				self._finish_response(cache_key, full_layout_response_content.getvalue())
 
 		except Exception as e:
-			error_message = f"[LayoutChat Error: Error during layout model streaming: {e}]"
-			yield error_message
-			if self.verbose:
-				import traceback
-				traceback.print_exc(file=sys.stderr)
+			yield self._streaming_error(e)
 			return
 
 		if self.verbose: print("\n--- LayoutChat: Processing Complete ---")
 
+	async def abatch(self, items: List[Dict[str, Any]]) -> List[str]:
+		"""
+		Runs several layout requests concurrently so Ollama can serve them in parallel
+		(see OLLAMA_NUM_PARALLEL) instead of one after another.
+
+		Args:
+			items: One dict of `arun` keyword arguments per request
+				(agent_output_str, user_original_query, and optionally content_images / layout_inspiration_screenshots).
+
+		Returns:
+			List[str]: The full formatted response of each request, in the same order as ``items``.
+		"""
+		async def collect(item: Dict[str, Any]) -> str:
+			return "".join([chunk async for chunk in self.arun(**item)])
+
+		return list(await asyncio.gather(*(collect(item) for item in items)))
+
 
 if __name__ == "__main__":
 	output_file = "output_layout.html" # Changed output file name
@@ -319,15 +1097,11 @@ if __name__ == "__main__":
 		layout_inspiration_screenshots=layout_inspiration_paths
 	)
 
-	# Empty the output file before writing
-	with open(output_file, "w", encoding="utf-8") as f: # Added encoding
-		f.write("")
-
 	print(f"\n--- LayoutChat Enhanced Output (streaming to console and {output_file}) ---")
-	for chunk in response_iterator:
-		print(chunk, end="", flush=True)
-		# Save the final response to a file
-		with open(output_file, "a", encoding="utf-8") as f: # Added encoding
+	# Open (and empty) the output file once; chunks are written through its buffer
+	with open(output_file, "w", encoding="utf-8", buffering=8192) as f:
+		for chunk in response_iterator:
+			print(chunk, end="", flush=True)
 			f.write(chunk)
 	print() # Newline after streaming
 
@@ -5,6 +5,7 @@ import traceback
 from typing import List, Callable, Iterator, Dict, Any, Optional
 import time
 import json
+import re
 
 # Langchain imports
 from langchain_ollama.chat_models import ChatOllama
@@ -13,6 +14,7 @@ from langchain_core.messages import AIMessageChunk, HumanMessage, ToolMessage, B
 
 # Tool imports
 from tools import general_web_search, find_interesting_links, news_search, weather_search, extract_web_content
+from tools import prefetch_web_search, discard_prefetched_searches
 
 # Model names import
 from config import MAIN_MODEL, VERBOSE, IMAGES_DIR, SCREENSHOTS_DIR
@@ -20,6 +22,10 @@ from config import MAIN_MODEL, VERBOSE, IMAGES_DIR, SCREENSHOTS_DIR
 # LayoutChat import
 from layout_chat import LayoutChat
 
+# Raw user queries that almost always end up in a web search; used to prefetch results speculatively.
+# "news" is left out: those queries go to news_search, which a prefetched web search can't serve.
+_NEEDS_SEARCH_RE = re.compile(r'\b(latest|recent|today|current|2024|2025)\b', re.I)
+
 
 class OptimizedLangchainAgent:
 	"""
@@ -160,7 +166,7 @@ class OptimizedLangchainAgent:
 			traceback.print_exc(file=sys.stderr)
 			return ToolMessage(content=error_msg, tool_call_id=tool_call_id)
 
-	def run(self, task: str, empty_data_folders: bool = True, data_folders: list[str] = [IMAGES_DIR, SCREENSHOTS_DIR]) -> Iterator[str]:
+	def run(self, task: str, empty_data_folders: bool = True, data_folders: list[str] = [IMAGES_DIR, SCREENSHOTS_DIR], user_original_query: Optional[str] = None) -> Iterator[str]:
 		if empty_data_folders and data_folders:
 			if self.verbose_agent: print(f"--- Agent: Clearing data folders: {data_folders} ---", file=sys.stderr)
 			for folder in data_folders:
@@ -192,6 +198,12 @@ class OptimizedLangchainAgent:
 
 		messages: List[BaseMessage] = [HumanMessage(content=task)]
 
+		# Speculatively start the search (and top-1 scrape) in parallel with the first LLM prefill.
+		# Only the raw user query is used: the assembled task also carries the date preamble and chat history.
+		prefetch_session = None
+		if user_original_query and general_web_search.name in self.tool_map and _NEEDS_SEARCH_RE.search(user_original_query):
+			prefetch_session = prefetch_web_search(user_original_query)
+
 		try:
 			for iteration in range(self.max_iterations):
 				if self.verbose_agent: print(f"\n--- Agent Iteration {iteration + 1}/{self.max_iterations} ---", file=sys.stderr)
@@ -261,6 +273,9 @@ class OptimizedLangchainAgent:
 			print(f"\n--- Error during Agent Execution (in run loop): {e} ---", file=sys.stderr)
 			traceback.print_exc(file=sys.stderr)
 			yield f"\n[Agent Error: An unexpected error occurred during execution. Details: {e}]"
+		finally:
+			if prefetch_session is not None:
+				discard_prefetched_searches(prefetch_session)
 
 	def _get_image_files_in_dir(self, dir_path: str) -> set[str]:
 		"""Helper to get a set of full paths to image files in a directory."""
@@ -317,7 +332,7 @@ class OptimizedLangchainAgent:
 		agent_response_parts = []
 		try:
 			# self.run will handle clearing/creating folders in `data_folders` list
-			for chunk in self.run(task, empty_data_folders, data_folders):
+			for chunk in self.run(task, empty_data_folders, data_folders, user_original_query=user_original_query):
 				agent_response_parts.append(chunk)
 		except Exception as e:
 			yield f"[Agent Error in run_layout during self.run: {e}]"
@@ -4,6 +4,8 @@ import json
 import sys
 import os
 import concurrent.futures
+import contextvars
+import threading
 from typing import List, Dict, Optional
 from bs4 import BeautifulSoup
 
@@ -29,6 +31,124 @@ assert OPEN_WEATHER_API_KEY, "OPEN_WEATHER_API_KEY must be set in .env file"
 
 _brave_search_client = BraveSearchManual(api_key=BRAVE_API_KEY)
 
+# Speculative prefetch: searches started before the LLM decides to call a tool.
+_PREFETCH_POOL = concurrent.futures.ThreadPoolExecutor(max_workers=4)
+
+# Filler words dropped before comparing queries: the model rewrites "what is the latest on X?" as "X latest"
+_QUERY_STOPWORDS = frozenset((
+	"a an and are as at be by can do does for from how i in is it me of on or please show tell that the "
+	"to was what whats when where which who why will with you about any some there s"
+).split())
+# Minimum Jaccard similarity between the token sets of a tool query and a prefetched query to reuse it
+_PREFETCH_MIN_SIMILARITY = 0.6
+
+def _query_tokens(query: str) -> frozenset:
+	return frozenset(t for t in re.findall(r"\w+", str(query).lower()) if t not in _QUERY_STOPWORDS)
+
+class PrefetchSession:
+	"""
+	Prefetched searches (and top-result scrapes) of a single agent run.
+	Each run owns its session, so concurrent requests never reuse or discard each other's prefetches.
+	"""
+	def __init__(self):
+		self._lock = threading.Lock()
+		self._searches: Dict[frozenset, concurrent.futures.Future] = {} # Keyed by _query_tokens
+		self._scrapes: Dict[str, concurrent.futures.Future] = {}
+		self._closed = False
+
+	def _search_and_prefetch_top(self, query: str, count: int) -> List[Dict]:
+		results = _brave_search_client.search_web(query, count=count)
+		top_url = results[0].get("url") if results else None
+		with self._lock:
+			# A search finishing after discard() must not leave behind a scrape nobody will clear
+			if top_url and not self._closed and top_url not in self._scrapes:
+				self._scrapes[top_url] = _PREFETCH_POOL.submit(_scrape_and_extract_text, top_url)
+		return results
+
+	def prefetch_search(self, query: str, count: int) -> None:
+		key = _query_tokens(query)
+		with self._lock:
+			if key and not self._closed and key not in self._searches:
+				if VERBOSE: print(f"--- Prefetching web search for '{query}' ---", file=sys.stderr)
+				self._searches[key] = _PREFETCH_POOL.submit(self._search_and_prefetch_top, query, count)
+
+	def pop_search(self, query: str) -> Optional[concurrent.futures.Future]:
+		"""Takes the prefetched search most similar to ``query`` (token-set Jaccard >= _PREFETCH_MIN_SIMILARITY), if any."""
+		tokens = _query_tokens(query)
+		if not tokens:
+			return None
+		with self._lock:
+			best_key, best_similarity = None, _PREFETCH_MIN_SIMILARITY
+			for key in self._searches:
+				similarity = len(tokens & key) / len(tokens | key)
+				if similarity >= best_similarity:
+					best_key, best_similarity = key, similarity
+			return self._searches.pop(best_key) if best_key is not None else None
+
+	def pop_scrape(self, url: str) -> Optional[concurrent.futures.Future]:
+		with self._lock:
+			return self._scrapes.pop(url, None)
+
+	def discard(self) -> None:
+		"""Cancels/drops this session's prefetched searches and scrapes that were not consumed."""
+		with self._lock:
+			self._closed = True
+			for futures in (self._searches, self._scrapes):
+				for future in futures.values():
+					future.cancel()
+				futures.clear()
+
+# Session of the agent run executing on the current thread (tools are invoked synchronously from the run)
+_active_prefetch: contextvars.ContextVar[Optional[PrefetchSession]] = contextvars.ContextVar("_active_prefetch", default=None)
+
+def prefetch_web_search(query: str, count: int = 5) -> PrefetchSession:
+	"""
+	Starts a web search for ``query`` (and a scrape of its top result) in the background, in a new
+	session that becomes active for the calling thread. A later `general_web_search` /
+	`extended_web_search` call from the same run with a similar query (same key words in any order,
+	no freshness) reuses the result instead of hitting the API again.
+	Pass the returned session to `discard_prefetched_searches` when the run ends.
+	"""
+	session = PrefetchSession()
+	session.prefetch_search(query, count)
+	_active_prefetch.set(session)
+	return session
+
+def discard_prefetched_searches(session: PrefetchSession) -> None:
+	"""Cancels/drops the unconsumed prefetches of ``session`` only, and deactivates it."""
+	session.discard()
+	if _active_prefetch.get() is session:
+		_active_prefetch.set(None)
+
+def _search_web(query: str, count: int, freshness: Optional[str] = None) -> List[Dict]:
+	"""Brave web search that first tries to reuse a matching prefetched result of the current run."""
+	session = _active_prefetch.get()
+	future = session.pop_search(query) if session is not None and not freshness else None
+	if future is not None:
+		try:
+			results = future.result()
+			if len(results) >= count:
+				if VERBOSE: print(f"--- Reusing prefetched web search for '{query}' ---", file=sys.stderr)
+				return results[:count]
+		except Exception as e:
+			if VERBOSE: print(f"--- Prefetched web search failed for '{query}': {e} ---", file=sys.stderr)
+	search_params = {"freshness": freshness} if freshness else {}
+	return _brave_search_client.search_web(query, count=count, **search_params)
+
+def _scrape_with_prefetch(url: str, max_chars: int | None = 2500, session: Optional[PrefetchSession] = None) -> Optional[str]:
+	"""
+	Same as `_scrape_and_extract_text`, reusing a prefetched scrape of ``url`` when available.
+	``session`` defaults to the current run's; pass it explicitly from worker threads.
+	"""
+	session = session if session is not None else _active_prefetch.get()
+	future = session.pop_scrape(url) if session is not None and max_chars == 2500 else None
+	if future is not None:
+		try:
+			return future.result()
+		except Exception as e:
+			if VERBOSE: print(f"--- Prefetched scrape failed for {url}: {e} ---", file=sys.stderr)
+	return _scrape_and_extract_text(url, max_chars=max_chars)
+
 def _generate_safe_filename(text: str, max_length: int = 50) -> str:
 	text = str(text)
 	text = re.sub(r'[<>:"/\\|?*.\s]', '_', text)
@@ -59,8 +179,7 @@ def general_web_search(query: str, k: int = 3, freshness: Optional[str] = None)
 	k = min(k, 5)
 
 	try:
-		search_params = {"freshness": freshness} if freshness else {}
-		results_list = _brave_search_client.search_web(query, count=k, **search_params)
+		results_list = _search_web(query, count=k, freshness=freshness)
 
 		try:
 			_brave_search_client.search_images(
@@ -102,6 +221,22 @@ def general_web_search(query: str, k: int = 3, freshness: Optional[str] = None)
 		return json.dumps({"error": f"Unexpected error: {e_main}", "results": []})
 
 
+def _collect_text(node, max_chars: int | None = None) -> str:
+	"""
+	Collects whitespace-normalized text from a BeautifulSoup node by iterating its strings.
+	Stops walking the tree as soon as ``max_chars`` characters have been gathered.
+	"""
+	parts: List[str] = []
+	length = 0
+	for string in node.strings:
+		words = string.split()
+		if not words: continue
+		chunk = " ".join(words)
+		parts.append(chunk)
+		length += len(chunk) + 1
+		if max_chars is not None and length > max_chars: break
+	return " ".join(parts)
+
 def _scrape_and_extract_text(url: str, timeout: int = 10, max_chars: int | None = 2500) -> Optional[str]:
 	try:
 		headers = {
@@ -119,8 +254,7 @@ def _scrape_and_extract_text(url: str, timeout: int = 10, max_chars: int | None
 					   soup.find('div', attrs={'role': 'main'}) or \
 					   soup.find('div', id='content') or \
 					   soup.find('div', class_='content') or soup.body
-		text = main_content.get_text(separator=' ', strip=True) if main_content else ""
-		text = re.sub(r'\s+', ' ', text).strip()
+		text = _collect_text(main_content, max_chars) if main_content else ""
 		if max_chars is not None and len(text) > max_chars:
 			text = text[:max_chars] + "..."
 		if VERBOSE: print(f"--- Scraped {len(text)} characters from {url} ---", file=sys.stderr)
@@ -155,7 +289,7 @@ def extract_web_content(url: str, max_chars: Optional[int] = 2500) -> str:
 	"""
 	if VERBOSE: print(f"--- TOOL: Extracting content from URL: {url} (max_chars: {max_chars}) ---", file=sys.stderr)
 	try:
-		content = _scrape_and_extract_text(url, max_chars=max_chars)
+		content = _scrape_with_prefetch(url, max_chars=max_chars)
 		if content is None: # _scrape_and_extract_text now returns None on failure or non-HTML
 			return f"Error: Could not extract content from {url}. It might be non-HTML, inaccessible, or timed out."
 		return content
@@ -203,15 +337,38 @@ def extended_web_search(query: str, k: int = 2, freshness: Optional[str] = None,
 		except Exception as e_img:
 			if VERBOSE: print(f"--- Error saving images for extended_web_search '{query}': {e_img} ---", file=sys.stderr)
 			
-		search_params = {"freshness": freshness} if freshness else {}
-		initial_results = _brave_search_client.search_web(query, count=num_to_scrape, **search_params)
+		# Ask for extra results (free within one API call) so dedupe/failed scrapes still leave k results
+		initial_results = _search_web(query, count=min(num_to_scrape * 2, 10), freshness=freshness)
 
-		urls_to_scrape = [r.get("url") for r in initial_results if r.get("url")]
+		urls_to_scrape = list(dict.fromkeys(r.get("url") for r in initial_results if r.get("url"))) # Unique, in rank order
 		if not urls_to_scrape: return {"results": []}
 
+		if VERBOSE: print(f"--- TOOL: Starting concurrent scraping for {len(urls_to_scrape)} URLs... ---", file=sys.stderr)
+		# Scrape every candidate concurrently, but only wait (in rank order) until k have succeeded;
+		# slower lower-ranked fetches are cancelled/abandoned instead of holding up the result
+		prefetch_session = _active_prefetch.get() # Context variables don't reach the worker threads
+		executor = concurrent.futures.ThreadPoolExecutor(max_workers=len(urls_to_scrape))
+		try:
+			futures = [executor.submit(_scrape_with_prefetch, url, max_chars, prefetch_session) for url in urls_to_scrape]
+			final_scraped_results = []
+			for url, future in zip(urls_to_scrape, futures):
+				try:
+					content = future.result()
+				except Exception as exc:
+					if VERBOSE: print(f'--- TOOL: Scraping thread exception for {url}: {exc} ---', file=sys.stderr)
+					content = None
+				if content is not None: # Skip entries where scraping failed
+					final_scraped_results.append({"url": url, "content": content})
+					if len(final_scraped_results) == num_to_scrape:
+						break
+		finally:
+			executor.shutdown(wait=False, cancel_futures=True)
+
+		# Screenshots of exactly the pages whose content is returned
 		os.makedirs(SCREENSHOTS_DIR, exist_ok=True)
 		query_slug = _generate_safe_filename(query)
-		for i, url in enumerate(urls_to_scrape):
+		for i, result in enumerate(final_scraped_results):
+			url = result["url"]
 			ss_filename = f"{datetime.now().strftime('%d-%m-%y_%H_%M')}_extended_search_ss_{query_slug}_{i}.png"
 			ss_path = os.path.join(SCREENSHOTS_DIR, ss_filename)
 			try:
@@ -220,25 +377,6 @@ def extended_web_search(query: str, k: int = 2, freshness: Optional[str] = None,
 			except Exception as e_ss:
 				if VERBOSE: print(f"--- Failed to take screenshot for {url}: {e_ss} ---", file=sys.stderr)
 
-		if VERBOSE: print(f"--- TOOL: Starting concurrent scraping for {len(urls_to_scrape)} URLs... ---", file=sys.stderr)
-		with concurrent.futures.ThreadPoolExecutor(max_workers=num_to_scrape) as executor:
-			future_to_url = {executor.submit(_scrape_and_extract_text, url, max_chars=max_chars): url for url in urls_to_scrape}
-			scrape_results_map = {}
-			for future in concurrent.futures.as_completed(future_to_url):
-				url = future_to_url[future]
-				try:
-					scrape_results_map[url] = future.result()
-				except Exception as exc:
-					if VERBOSE: print(f'--- TOOL: Scraping thread exception for {url}: {exc} ---', file=sys.stderr)
-					scrape_results_map[url] = None
-
-		final_scraped_results = [
-			{"url": url, "content": scrape_results_map.get(url)}
-			for url in urls_to_scrape
-		]
-		# Filter out entries where scraping failed
-		final_scraped_results = [r for r in final_scraped_results if r["content"] is not None]
-
 		# if VERBOSE: print(f"--- TOOL: Returning {len(final_scraped_results)} results ---", file=sys.stderr)
 		# with open("search_results.txt", "a") as f:
 		# 	f.write(f"TOOL: Extended Web Search for '{query}'\n")